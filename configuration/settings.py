@@ -139,6 +139,22 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 
+# Các tác vụ quét/dọn dẹp/sao lưu chạy lâu: mỗi worker chỉ nhận 1 tác vụ một lúc
+# và chỉ ack sau khi xong, để tác vụ được trả lại hàng đợi nếu worker bị mất.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+# Khởi động lại tiến trình con định kỳ (chỉ có tác dụng với pool prefork của hàng đợi backup/maint;
+# pool gevent của hàng đợi scan không tái khởi động tiến trình)
+CELERY_WORKER_MAX_TASKS_PER_CHILD = 100
+
+# Tách hàng đợi: quét (I/O mạng, pool gevent) và bảo trì/sao lưu (DB/đĩa, pool prefork)
+CELERY_TASK_ROUTES = {
+    'tasks.scan_all_inventories': {'queue': 'scan'},
+    'tasks.backup_database': {'queue': 'backup'},
+    'tasks.cleanup_old_records': {'queue': 'maint'},
+}
+
 # --- CẤU HÌNH CELERY BEAT (SCHEDULER) ---
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
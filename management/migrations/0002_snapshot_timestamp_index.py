@@ -0,0 +1,17 @@
+# Generated by Django 5.2.3 on 2026-10-14 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('management', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='snapshot',
+            index=models.Index(fields=['timestamp'], name='snapshot_timestamp_idx'),
+        ),
+    ]
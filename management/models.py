@@ -61,6 +61,9 @@ class Snapshot(models.Model):
         verbose_name = "Bản ghi quỹ căn hộ"
         verbose_name_plural = "Danh sách bản ghi quỹ căn hộ"
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp'], name='snapshot_timestamp_idx'),
+        ]
 
 class ColumnMapping(models.Model):
     project_config = models.ForeignKey(ProjectConfig, on_delete=models.CASCADE, related_name="column_mappings", verbose_name="Cấu hình Dự án")
@@ -1,11 +1,13 @@
 import os
 import logging
-import shutil
+import sqlite3
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
 
 from celery import shared_task
 from django.conf import settings
+from django.db import connection, transaction
 from django.utils import timezone
 from worker.inventory_scanner.InventoryScanner import InventoryScanner
 from .models import SystemConfig, WorkerLog, InventoryChange, Snapshot
@@ -13,6 +15,14 @@ from .models import SystemConfig, WorkerLog, InventoryChange, Snapshot
 # Lấy ra logger đã được cấu hình sẵn bởi Django/Celery
 logger = logging.getLogger(__name__)
 
+# Giữ lại InventoryScanner giữa các lần chạy tác vụ để tái sử dụng kết nối database và HTTP session.
+# Chỉ giữ scanner của (bot token, proxy) hiện tại: khi cấu hình đổi, scanner cũ được close() ngay.
+# Hàng đợi quét chạy pool gevent (nhiều greenlet trong cùng tiến trình, không bao giờ bị tái khởi động
+# theo worker_max_tasks_per_child), nên mỗi lúc chỉ cho một lần quét chạy trên scanner dùng chung.
+_scanner_key = None
+_scanner = None
+_scan_lock = threading.Lock()
+
 
 @shared_task(name="tasks.scan_all_inventories")
 def scan_all_inventories_task():
@@ -20,7 +30,12 @@ def scan_all_inventories_task():
     Tác vụ Celery để quét tất cả kho hàng.
     Lấy cấu hình (bot token, proxy) từ model SystemConfig.
     """
+    global _scanner_key, _scanner
     logger.info("Bắt đầu tác vụ quét kho hàng...")
+    # Một lần quét khác vẫn đang chạy: bỏ qua lượt này thay vì chạy chồng trên cùng scanner
+    if not _scan_lock.acquire(blocking=False):
+        logger.warning("Lần quét trước vẫn đang chạy, bỏ qua lượt quét này.")
+        return "Scan skipped: previous scan still running."
     try:
         # Tải cấu hình từ database
         config = SystemConfig.load()
@@ -35,15 +50,23 @@ def scan_all_inventories_task():
             proxies = {'http': proxy_url, 'https': proxy_url}
             logger.info(f"Sử dụng proxy: {proxy_url}")
 
-        # Khởi tạo scanner với token và proxy
-        scanner = InventoryScanner(bot_token=bot_token, proxies=proxies)
-        scanner.run()
+        # Dùng lại scanner nếu token và proxy không đổi; nếu đổi thì đóng scanner cũ rồi tạo mới
+        scanner_key = (bot_token, proxy_url)
+        if _scanner is None or _scanner_key != scanner_key:
+            old_scanner, _scanner, _scanner_key = _scanner, None, None
+            if old_scanner is not None:
+                old_scanner.close()
+            _scanner = InventoryScanner(bot_token=bot_token, proxies=proxies)
+            _scanner_key = scanner_key
+        _scanner.run()
 
         logger.info("Hoàn thành tác vụ quét kho hàng thành công.")
         return "Scan completed successfully."
     except Exception as e:
         logger.error(f"Đã xảy ra lỗi trong quá trình quét kho hàng: {e}", exc_info=True)
         return f"Scan failed with error: {e}"
+    finally:
+        _scan_lock.release()
 
 
 @shared_task(name="tasks.cleanup_old_records")
@@ -55,18 +78,25 @@ def cleanup_old_records_task():
     cutoff_date = timezone.now() - timedelta(days=days_to_keep)
     logger.info(f"Bắt đầu tác vụ dọn dẹp. Xóa các bản ghi cũ hơn ngày: {cutoff_date.strftime('%Y-%m-%d')}")
 
+    def delete_older_than(cursor, model):
+        # Xóa trực tiếp bằng SQL để tránh collector của ORM tải từng bản ghi
+        cursor.execute(f"DELETE FROM {model._meta.db_table} WHERE timestamp < %s", [cutoff_date])
+        return cursor.rowcount
+
     try:
-        # Xóa WorkerLog cũ
-        logs_deleted, _ = WorkerLog.objects.filter(timestamp__lt=cutoff_date).delete()
-        logger.info(f"Đã xóa {logs_deleted} bản ghi WorkerLog cũ.")
+        # Xóa cả ba bảng trong cùng một transaction
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Xóa WorkerLog cũ
+            logs_deleted = delete_older_than(cursor, WorkerLog)
+            logger.info(f"Đã xóa {logs_deleted} bản ghi WorkerLog cũ.")
 
-        # Xóa InventoryChange cũ
-        changes_deleted, _ = InventoryChange.objects.filter(timestamp__lt=cutoff_date).delete()
-        logger.info(f"Đã xóa {changes_deleted} bản ghi InventoryChange cũ.")
+            # Xóa InventoryChange cũ
+            changes_deleted = delete_older_than(cursor, InventoryChange)
+            logger.info(f"Đã xóa {changes_deleted} bản ghi InventoryChange cũ.")
 
-        # Xóa Snapshot cũ
-        snapshots_deleted, _ = Snapshot.objects.filter(timestamp__lt=cutoff_date).delete()
-        logger.info(f"Đã xóa {snapshots_deleted} bản ghi Snapshot cũ.")
+            # Xóa Snapshot cũ
+            snapshots_deleted = delete_older_than(cursor, Snapshot)
+            logger.info(f"Đã xóa {snapshots_deleted} bản ghi Snapshot cũ.")
 
         logger.info("Hoàn thành tác vụ dọn dẹp thành công.")
         return f"Cleanup successful. Deleted: {logs_deleted} logs, {changes_deleted} changes, {snapshots_deleted} snapshots."
@@ -102,8 +132,17 @@ def backup_database_task():
         return "Source database not found."
 
     try:
-        # Thực hiện sao chép file
-        shutil.copyfile(db_source_path, db_backup_path)
+        # Sao chép qua backup API của SQLite thay vì copy file: database chạy ở chế độ WAL,
+        # các transaction đã commit có thể vẫn nằm trong file -wal chưa được checkpoint
+        source = sqlite3.connect(db_source_path)
+        try:
+            target = sqlite3.connect(db_backup_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
         logger.info(f"Đã tạo backup database thành công tại: {db_backup_path}")
         return f"Backup successful: {db_backup_path}"
     except Exception as e:
@@ -1,3 +1,46 @@
-from django.test import TestCase
+import re
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from worker.inventory_scanner.TelegramNotifier import _LIMIT, _split_message
+
+_TAG_RE = re.compile(r'<(/?)(\w+)[^>]*>')
+
+
+class SplitMessageTests(SimpleTestCase):
+    """Kiểm tra việc tách tin nhắn dài của TelegramNotifier."""
+
+    def assertValidChunk(self, chunk):
+        """Mỗi phần phải nằm trong giới hạn, thẻ HTML cân bằng và không có thực thể bị cắt ngang."""
+        self.assertLessEqual(len(chunk), _LIMIT)
+        open_tags = []
+        for match in _TAG_RE.finditer(chunk):
+            if match.group(1):
+                self.assertTrue(open_tags, f"Thẻ đóng thừa </{match.group(2)}>")
+                self.assertEqual(open_tags.pop(), match.group(2))
+            else:
+                open_tags.append(match.group(2))
+        self.assertEqual(open_tags, [], "Còn thẻ chưa đóng")
+        for match in re.finditer('&', chunk):
+            self.assertRegex(chunk[match.start():], r'^&#?\w+;')
+
+    def test_short_message_is_unchanged(self):
+        self.assertEqual(_split_message("<b>ABC123</b>"), ["<b>ABC123</b>"])
+
+    def test_long_line_inside_blockquote(self):
+        text = "hdr\n<blockquote>" + "a" * 9000 + "\nshort\n</blockquote>"
+        chunks = _split_message(text)
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertValidChunk(chunk)
+        self.assertEqual("".join(re.sub(r'<[^>]*>|\s', '', c) for c in chunks), "hdr" + "a" * 9000 + "short")
+
+    def test_long_line_never_cuts_tags_or_entities(self):
+        text = "<blockquote><b>" + "x&amp;" * 2000 + "</b></blockquote>"
+        chunks = _split_message(text)
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertValidChunk(chunk)
+        self.assertEqual(sum(c.count("&amp;") for c in chunks), 2000)
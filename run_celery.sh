@@ -9,6 +9,7 @@ mkdir -p $PID_DIR
 
 # Đường dẫn file PID
 WORKER_PID_FILE="$PID_DIR/worker.pid"
+MAINT_WORKER_PID_FILE="$PID_DIR/worker_maint.pid"
 BEAT_PID_FILE="$PID_DIR/beat.pid"
 
 # Hàm để bắt đầu các tiến trình
@@ -21,10 +22,19 @@ start() {
         echo "Celery Worker is already running (PID file exists)."
     else
         echo "Starting Celery Worker with gevent pool..."
-        celery -A $PROJECT_NAME.celery worker -P gevent --detach --pidfile=$WORKER_PID_FILE
+        celery -A $PROJECT_NAME.celery worker -Q scan -P gevent -c 50 -Ofair --detach --pidfile=$WORKER_PID_FILE
         echo "Celery Worker started."
     fi
 
+    # Worker cho các tác vụ sao lưu/dọn dẹp (DB và đĩa), dùng prefork
+    if [ -f $MAINT_WORKER_PID_FILE ]; then
+        echo "Celery Maintenance Worker is already running (PID file exists)."
+    else
+        echo "Starting Celery Maintenance Worker with prefork pool..."
+        celery -A $PROJECT_NAME.celery worker -Q backup,maint -P prefork -c 2 -Ofair -n maint@%h --detach --pidfile=$MAINT_WORKER_PID_FILE
+        echo "Celery Maintenance Worker started."
+    fi
+
     # Kiểm tra xem Beat đã chạy chưa
     if [ -f $BEAT_PID_FILE ]; then
         echo "Celery Beat is already running (PID file exists)."
@@ -49,6 +59,16 @@ stop() {
         echo "Celery Worker is not running (PID file not found)."
     fi
 
+    # Dừng Maintenance Worker
+    if [ -f $MAINT_WORKER_PID_FILE ]; then
+        echo "Stopping Celery Maintenance Worker..."
+        kill $(cat $MAINT_WORKER_PID_FILE)
+        rm $MAINT_WORKER_PID_FILE
+        echo "Celery Maintenance Worker stopped."
+    else
+        echo "Celery Maintenance Worker is not running (PID file not found)."
+    fi
+
     # Dừng Beat
     if [ -f $BEAT_PID_FILE ]; then
         echo "Stopping Celery Beat..."
@@ -1,81 +1,259 @@
 import sqlite3
 import logging
 import json
+import time
 import datetime
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import timezone
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Iterator, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, dùng json chuẩn nếu chưa cài
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Một dòng column mapping: (internal_name, display_name, aliases, is_identifier);
+# aliases đã được parse thành tuple (None nếu JSON không hợp lệ)
+ColMap = namedtuple('ColMap', 'internal_name display_name aliases is_identifier')
+
+# Thời gian (giây) giữ cache cấu hình dự án và column mappings trong tiến trình
+CONFIG_CACHE_TTL = 60
+
+# Các câu lệnh SQL dùng chung, khai báo một lần để sqlite3 tái sử dụng prepared statement
+_SQL_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+"""
+
+_SQL_GET_ACTIVE_CONFIGS = """
+    SELECT
+        pc.*,
+        p.name as project_name,
+        p.key_prefixes,
+        p.telegram_chat_id,
+        a.name as agent_name
+    FROM
+        management_projectconfig pc
+    JOIN
+        management_agent a ON pc.agent_id = a.id
+    JOIN
+        management_project p ON pc.project_id = p.id
+    WHERE
+        pc.is_active = 1;
+"""
+
+_SQL_GET_LATEST_SNAPSHOT = """
+    SELECT data FROM management_snapshot
+    WHERE project_data_source_id = ?
+    ORDER BY timestamp DESC
+    LIMIT 1;
+"""
+
+_SQL_INSERT_SNAPSHOT = """
+    INSERT INTO management_snapshot (timestamp, project_data_source_id, data)
+    VALUES (?, ?, ?);
+"""
+
+# Làm mới thời gian của snapshot gần nhất (sheet không đổi) để tác vụ dọn dẹp không xóa mất nó
+_SQL_TOUCH_LATEST_SNAPSHOT = """
+    UPDATE management_snapshot SET timestamp = ?
+    WHERE id = (
+        SELECT id FROM management_snapshot
+        WHERE project_data_source_id = ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    );
+"""
+
+_SQL_GET_UNIT_POLICIES = "SELECT unit_code, sales_policy FROM management_apartmentunit WHERE project_config_id = ?"
+_SQL_DELETE_UNIT = "DELETE FROM management_apartmentunit WHERE project_config_id = ? AND unit_code = ?"
+_SQL_INSERT_UNIT = "INSERT INTO management_apartmentunit (project_config_id, unit_code, sales_policy, created_at, updated_at) VALUES (?, ?, ?, ?, ?)"
+_SQL_UPDATE_UNIT_POLICY = "UPDATE management_apartmentunit SET sales_policy = ?, updated_at = ? WHERE project_config_id = ? AND unit_code = ?"
+
+_SQL_INSERT_INVENTORY_CHANGE = """
+    INSERT INTO management_inventorychange (project_config_id, timestamp, change_type, apartment_key, details)
+    VALUES (?, ?, ?, ?, ?);
+"""
+
+_SQL_GET_COLUMN_MAPPINGS = """
+    SELECT internal_name, display_name, aliases, is_identifier
+    FROM management_columnmapping
+    WHERE project_config_id = ?
+"""
+
+def _dumps(data: Any) -> str:
+    """Serialize dữ liệu thành chuỗi JSON gọn (UTF-8, giữ nguyên ký tự tiếng Việt)."""
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+def _loads(raw: Any) -> Any:
+    """Parse chuỗi JSON đã lưu trong database."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def _parse_config(row: sqlite3.Row) -> Dict[str, Any]:
+    """Chuyển một dòng cấu hình thành dict, parse sẵn các trường JSON dùng khi quét.
+
+    Thêm `invalid_colors_set` (các màu viết thường) và `key_prefixes_upper`
+    (tuple tiền tố viết hoa, None nếu không giới hạn tiền tố).
+    """
+    config = dict(row)
+    invalid_colors = _loads(config.get('invalid_colors') or '[]')
+    config['invalid_colors_set'] = frozenset(str(color).lower() for color in invalid_colors)
+    prefixes = _loads(config['key_prefixes']) if config.get('key_prefixes') else None
+    config['key_prefixes_upper'] = tuple(str(prefix).upper() for prefix in prefixes) if prefixes else None
+    return config
+
+def _parse_aliases(raw: Any) -> Optional[Tuple[str, ...]]:
+    """Parse danh sách aliases của một column mapping, trả về None nếu JSON không hợp lệ."""
+    try:
+        return tuple(_loads(raw)) if raw else ()
+    except (ValueError, TypeError):
+        return None
+
 class DatabaseManager:
     """Quản lý tất cả các tương tác với cơ sở dữ liệu SQLite."""
 
     def __init__(self, db_file: str = 'app.db'):
         self.db_file = db_file
         self.conn = None
+        self._active_configs_cache: Optional[Tuple[float, List[Dict[str, Any]]]] = None
+        self._mapping_cache: Dict[int, Tuple[float, List[ColMap]]] = {}
+        # Độ sâu transaction() đang mở và cờ đánh dấu có lỗi bên trong
+        self._tx_depth = 0
+        self._tx_failed = False
         try:
-            self.conn = sqlite3.connect(self.db_file)
+            self.conn = sqlite3.connect(self.db_file, cached_statements=256)
             self.conn.row_factory = sqlite3.Row
-            logger.info(f"Đã kết nối thành công đến database: {self.db_file}")
+            # WAL + synchronous=NORMAL: mỗi commit chỉ cần một lần ghi tuần tự thay vì hai lần fsync
+            self.conn.executescript(_SQL_PRAGMAS)
+            logger.info("Đã kết nối thành công đến database: %s", self.db_file)
         except sqlite3.Error as e:
-            logger.error(f"Lỗi khi kết nối đến database: {e}")
+            logger.error("Lỗi khi kết nối đến database: %s", e)
+            raise
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Gộp các thao tác ghi bên trong vào một transaction: commit một lần khi thoát, rollback nếu có lỗi.
+        Có thể lồng nhau; chỉ transaction ngoài cùng mới commit/rollback.
+
+        Nếu một transaction lồng bên trong bị lỗi nhưng lỗi đó đã được bắt (ví dụ add_snapshots trả False),
+        transaction ngoài cùng vẫn rollback toàn bộ và raise sqlite3.Error, để các thao tác khác trong khối
+        không bị coi là đã lưu thành công.
+        """
+        self._tx_depth += 1
+        rolled_back = False
+        try:
+            yield self.conn
+        except BaseException:
+            self._tx_failed = True
             raise
+        finally:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                failed, self._tx_failed = self._tx_failed, False
+                if failed:
+                    self.conn.rollback()
+                    rolled_back = True
+                else:
+                    try:
+                        self.conn.commit()
+                    except sqlite3.Error:
+                        self.conn.rollback()
+                        raise
+        # Chỉ đến được đây khi không có ngoại lệ nào đang lan ra: lỗi bên trong đã bị nuốt
+        if rolled_back:
+            raise sqlite3.Error("Transaction đã bị rollback do lỗi ở một thao tác ghi bên trong")
 
-    def get_active_configs(self) -> List[sqlite3.Row]:
-        """Lấy danh sách tất cả các cấu hình đang hoạt động."""
+    def get_active_configs(self) -> List[Dict[str, Any]]:
+        """Lấy danh sách tất cả các cấu hình đang hoạt động, các trường JSON đã được parse sẵn (có cache trong CONFIG_CACHE_TTL giây)."""
+        cached = self._active_configs_cache
+        if cached and time.monotonic() - cached[0] < CONFIG_CACHE_TTL:
+            return cached[1]
         try:
             cursor = self.conn.cursor()
-            cursor.execute("""
-                SELECT
-                    pc.*,
-                    p.name as project_name,
-                    p.key_prefixes,
-                    p.telegram_chat_id,
-                    a.name as agent_name
-                FROM
-                    management_projectconfig pc
-                JOIN
-                    management_agent a ON pc.agent_id = a.id
-                JOIN
-                    management_project p ON pc.project_id = p.id
-                WHERE
-                    pc.is_active = 1;
-            """)
-            return cursor.fetchall()
+            cursor.execute(_SQL_GET_ACTIVE_CONFIGS)
+            configs = []
+            for row in cursor.fetchall():
+                try:
+                    configs.append(_parse_config(row))
+                except (ValueError, TypeError) as e:
+                    logger.error("Lỗi JSON trong cấu hình ID %s, bỏ qua cấu hình này: %s", row['id'], e)
+            self._active_configs_cache = (time.monotonic(), configs)
+            return configs
         except sqlite3.Error as e:
-            logger.error(f"Lỗi khi lấy danh sách cấu hình: {e}")
+            logger.error("Lỗi khi lấy danh sách cấu hình: %s", e)
             return []
 
     def get_latest_snapshot(self, project_config_id: int) -> Optional[Dict[str, Any]]:
         """Lấy snapshot gần nhất của một cấu hình dự án."""
         try:
             cursor = self.conn.cursor()
-            cursor.execute("""
-                SELECT data FROM management_snapshot
-                WHERE project_data_source_id = ?
-                ORDER BY timestamp DESC
-                LIMIT 1;
-            """, (project_config_id,))
+            cursor.execute(_SQL_GET_LATEST_SNAPSHOT, (project_config_id,))
             result = cursor.fetchone()
-            return json.loads(result['data']) if result else None
+            return _loads(result['data']) if result else None
         except (sqlite3.Error, json.JSONDecodeError) as e:
-            logger.error(f"Lỗi khi lấy snapshot gần nhất cho project_config_id {project_config_id}: {e}")
+            logger.error("Lỗi khi lấy snapshot gần nhất cho project_config_id %s: %s", project_config_id, e)
             return None
 
     def add_snapshot(self, project_config_id: int, data: Dict[str, Any]):
         """Thêm một snapshot mới cho một cấu hình dự án."""
+        self.add_snapshots([(project_config_id, data)])
+
+    def add_snapshots(self, rows: List[Tuple[int, Dict[str, Any]]]) -> bool:
+        """Thêm nhiều snapshot (project_config_id, data) trong cùng một transaction.
+
+        Returns:
+            True nếu lưu thành công (hoặc không có gì để lưu), False nếu lỗi.
+        """
+        if not rows:
+            return True
+        try:
+            current_timestamp = datetime.datetime.now(timezone.utc)
+            rows_prepared = [
+                (current_timestamp, project_config_id, _dumps(data))
+                for project_config_id, data in rows
+            ]
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.executemany(_SQL_INSERT_SNAPSHOT, rows_prepared)
+            logger.info("Đã thêm %s snapshot mới cho các project_config_id %s", len(rows_prepared), [r[0] for r in rows])
+            return True
+        except sqlite3.Error as e:
+            logger.error("Lỗi khi thêm snapshot: %s", e)
+            return False
+
+    def touch_latest_snapshots(self, project_config_ids: List[int]) -> bool:
+        """Cập nhật thời gian của snapshot gần nhất cho các cấu hình có nội dung sheet không đổi.
+
+        Snapshot gần nhất là mốc so sánh của lần quét sau; nếu không được làm mới, tác vụ dọn dẹp
+        sẽ xóa nó sau 30 ngày và lần quét kế tiếp sẽ báo toàn bộ căn hộ là mới.
+
+        Returns:
+            True nếu cập nhật thành công (hoặc không có gì để cập nhật), False nếu lỗi.
+        """
+        if not project_config_ids:
+            return True
         try:
-            cursor = self.conn.cursor()
             current_timestamp = datetime.datetime.now(timezone.utc)
-            cursor.execute("""
-                INSERT INTO management_snapshot (timestamp, project_data_source_id, data)
-                VALUES (?, ?, ?);
-            """, (current_timestamp, project_config_id, json.dumps(data, ensure_ascii=False)))
-            self.conn.commit()
-            logger.info(f"Đã thêm snapshot mới cho project_config_id {project_config_id}")
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.executemany(_SQL_TOUCH_LATEST_SNAPSHOT,
+                                   [(current_timestamp, config_id) for config_id in project_config_ids])
+            logger.info("Đã làm mới thời gian snapshot gần nhất cho các project_config_id %s", project_config_ids)
+            return True
         except sqlite3.Error as e:
-            logger.error(f"Lỗi khi thêm snapshot: {e}")
-            self.conn.rollback()
+            logger.error("Lỗi khi làm mới thời gian snapshot: %s", e)
+            return False
 
     def sync_apartment_units(self, project_config_id: int, new_snapshot: Dict[str, Dict[str, Any]]):
         """
@@ -87,89 +265,100 @@ class DatabaseManager:
         if not self.conn: return
 
         try:
-            cursor = self.conn.cursor()
-
-            cursor.execute("SELECT unit_code, sales_policy FROM management_apartmentunit WHERE project_config_id = ?", (project_config_id,))
-            db_units = {row['unit_code']: dict(row) for row in cursor.fetchall()}
-            db_unit_codes = set(db_units.keys())
+            # Toàn bộ xóa/thêm/cập nhật chạy trong một transaction: tự commit khi thành công, rollback khi lỗi
+            with self.transaction():
+                cursor = self.conn.cursor()
+                # Lấy thẳng các tuple (unit_code, sales_policy), không bọc từng dòng thành dict
+                cursor.row_factory = None
 
-            snapshot_unit_codes = set(new_snapshot.keys())
-            units_to_remove = db_unit_codes - snapshot_unit_codes
-            if units_to_remove:
-                params_to_delete = [(project_config_id, code) for code in units_to_remove]
-                cursor.executemany("DELETE FROM management_apartmentunit WHERE project_config_id = ? AND unit_code = ?", params_to_delete)
-                logger.info(f"[{project_config_id}] Đã xóa {len(units_to_remove)} căn khỏi quỹ căn.")
+                cursor.execute(_SQL_GET_UNIT_POLICIES, (project_config_id,))
+                db_policy = dict(cursor.fetchall())
+                db_unit_codes = db_policy.keys()
 
-            units_to_add = []
-            units_to_update = []
-            timestamp = datetime.datetime.now(timezone.utc)
+                snapshot_unit_codes = new_snapshot.keys()
+                units_to_remove = db_unit_codes - snapshot_unit_codes
+                if units_to_remove:
+                    cursor.executemany(
+                        _SQL_DELETE_UNIT,
+                        ((project_config_id, code) for code in units_to_remove)
+                    )
+                    logger.info("[%s] Đã xóa %s căn khỏi quỹ căn.", project_config_id, len(units_to_remove))
 
-            for unit_code, unit_data in new_snapshot.items():
-                new_policy = unit_data.get('sales_policy')
+                timestamp = datetime.datetime.now(timezone.utc)
+                units_to_add = snapshot_unit_codes - db_unit_codes
+                if units_to_add:
+                    cursor.executemany(
+                        _SQL_INSERT_UNIT,
+                        ((project_config_id, unit_code, new_snapshot[unit_code].get('sales_policy'), timestamp, timestamp)
+                         for unit_code in units_to_add)
+                    )
+                    logger.info("[%s] Đã thêm %s căn mới vào quỹ căn.", project_config_id, len(units_to_add))
 
-                if unit_code not in db_unit_codes:
-                    units_to_add.append((project_config_id, unit_code, new_policy, timestamp, timestamp))
-                else:
-                    current_policy = db_units[unit_code].get('sales_policy')
-                    if current_policy != new_policy:
-                        units_to_update.append((new_policy, timestamp, project_config_id, unit_code))
-
-            if units_to_add:
                 cursor.executemany(
-                    "INSERT INTO management_apartmentunit (project_config_id, unit_code, sales_policy, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
-                    units_to_add
+                    _SQL_UPDATE_UNIT_POLICY,
+                    ((new_policy, timestamp, project_config_id, unit_code)
+                     for unit_code in snapshot_unit_codes & db_unit_codes
+                     if (new_policy := new_snapshot[unit_code].get('sales_policy')) != db_policy[unit_code])
                 )
-                logger.info(f"[{project_config_id}] Đã thêm {len(units_to_add)} căn mới vào quỹ căn.")
+                units_updated = max(cursor.rowcount, 0)
+                if units_updated:
+                    logger.info("[%s] Đã cập nhật %s căn trong quỹ căn.", project_config_id, units_updated)
 
-            if units_to_update:
-                cursor.executemany(
-                    "UPDATE management_apartmentunit SET sales_policy = ?, updated_at = ? WHERE project_config_id = ? AND unit_code = ?",
-                    units_to_update
-                )
-                logger.info(f"[{project_config_id}] Đã cập nhật {len(units_to_update)} căn trong quỹ căn.")
-
-            if units_to_remove or units_to_add or units_to_update:
-                self.conn.commit()
-            else:
-                logger.info(f"[{project_config_id}] Quỹ căn không có thay đổi.")
+            if not (units_to_remove or units_to_add or units_updated):
+                logger.info("[%s] Quỹ căn không có thay đổi.", project_config_id)
 
         except sqlite3.Error as e:
-            logger.error(f"Lỗi khi đồng bộ quỹ căn cho project_config_id {project_config_id}: {e}")
-            self.conn.rollback()
+            logger.error("Lỗi khi đồng bộ quỹ căn cho project_config_id %s: %s", project_config_id, e)
 
     def add_inventory_change(self, project_config_id: int, change_type: str, apartment_key: str, details: Dict[str, Any]):
         """Thêm một bản ghi thay đổi vào bảng InventoryChange."""
-        if not self.conn:
+        self.add_inventory_changes(project_config_id, [(change_type, apartment_key, details)])
+
+    def add_inventory_changes(self, project_config_id: int, rows: List[Tuple[str, str, Dict[str, Any]]]):
+        """Thêm nhiều bản ghi thay đổi (change_type, apartment_key, details) của một dự án trong cùng một transaction."""
+        if not self.conn or not rows:
             return
         try:
-            cursor = self.conn.cursor()
             current_timestamp = datetime.datetime.now(timezone.utc)
-            cursor.execute("""
-                INSERT INTO management_inventorychange (project_config_id, timestamp, change_type, apartment_key, details)
-                VALUES (?, ?, ?, ?, ?);
-            """, (project_config_id, current_timestamp, change_type, apartment_key, json.dumps(details, ensure_ascii=False)))
-            self.conn.commit()
-            logger.info(f"Đã ghi nhận thay đổi '{change_type}' cho căn hộ '{apartment_key}' của dự án {project_config_id}")
+            rows_prepared = [
+                (project_config_id, current_timestamp, change_type, apartment_key, _dumps(details))
+                for change_type, apartment_key, details in rows
+            ]
+            with self.transaction():
+                cursor = self.conn.cursor()
+                cursor.executemany(_SQL_INSERT_INVENTORY_CHANGE, rows_prepared)
+            logger.info("Đã ghi nhận %s thay đổi quỹ căn của dự án %s", len(rows_prepared), project_config_id)
         except sqlite3.Error as e:
-            logger.error(f"Lỗi khi thêm bản ghi InventoryChange: {e}")
-            self.conn.rollback()
+            logger.error("Lỗi khi thêm bản ghi InventoryChange: %s", e)
 
-    def get_column_mappings(self, project_config_id):
-        """Lấy tất cả các column mappings cho một project config ID."""
+    def get_column_mappings(self, project_config_id) -> List[ColMap]:
+        """Lấy tất cả các column mappings cho một project config ID (có cache trong CONFIG_CACHE_TTL giây)."""
         if not self.conn: return []
+        cached = self._mapping_cache.get(project_config_id)
+        if cached and time.monotonic() - cached[0] < CONFIG_CACHE_TTL:
+            return cached[1]
         try:
             cursor = self.conn.cursor()
-            cursor.execute("""
-                SELECT internal_name, display_name, aliases, is_identifier
-                FROM management_columnmapping
-                WHERE project_config_id = ?
-            """, (project_config_id,))
-            mappings = cursor.fetchall()
-            return [dict(mapping) for mapping in mappings]
+            cursor.row_factory = None
+            cursor.execute(_SQL_GET_COLUMN_MAPPINGS, (project_config_id,))
+            mappings = [
+                ColMap(internal_name, display_name, _parse_aliases(aliases), is_identifier)
+                for internal_name, display_name, aliases, is_identifier in cursor.fetchall()
+            ]
+            self._mapping_cache[project_config_id] = (time.monotonic(), mappings)
+            return mappings
         except sqlite3.Error as e:
-            logger.error(f"Không thể lấy column mappings cho project {project_config_id}: {e}")
+            logger.error("Không thể lấy column mappings cho project %s: %s", project_config_id, e)
             return []
 
+    def invalidate_mappings(self, project_config_id: Optional[int] = None):
+        """Xóa cache column mappings của một dự án (hoặc tất cả nếu không truyền ID) và cache cấu hình."""
+        if project_config_id is None:
+            self._mapping_cache.clear()
+        else:
+            self._mapping_cache.pop(project_config_id, None)
+        self._active_configs_cache = None
+
     def close(self):
         """Đóng kết nối database."""
         if self.conn:
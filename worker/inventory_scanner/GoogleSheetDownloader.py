@@ -1,17 +1,28 @@
 import requests
-from bs4 import BeautifulSoup
+import lxml.html
 import pandas as pd
 import numpy as np
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
 from requests_kerberos import HTTPKerberosAuth
 from urllib3.util import parse_url
+from urllib3.util.retry import Retry
 import re
 import os
+import hashlib
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
 pd.set_option('future.no_silent_downcasting', True)
+
+_CSS_COLOR_RE = re.compile(r'\.ritz\s*\.waffle\s*\.s(\d+)\s*\{[^}]*background-color:\s*([^;]+);')
+_RGB_RE = re.compile(r'\d+')
+# Ô rỗng hoặc chỉ chứa khoảng trắng, áp dụng từng phần tử trên mảng object
+_is_blank = np.frompyfunc(lambda value: isinstance(value, str) and not value.strip(), 1, 1)
+
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
 class HTTPAdapterWithProxyKerberosAuth(requests.adapters.HTTPAdapter):
@@ -22,10 +33,35 @@ class HTTPAdapterWithProxyKerberosAuth(requests.adapters.HTTPAdapter):
         headers['Proxy-Authorization'] = negotiate_details
         return headers
 
+# Session dùng chung theo cấu hình proxy, để các lần tải tái sử dụng kết nối keep-alive/TLS
+_SESSIONS: Dict[Optional[tuple], requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+def get_shared_session(proxies: Optional[dict] = None) -> requests.Session:
+    """Trả về requests.Session dùng chung cho cấu hình proxy đã cho, tạo mới nếu chưa có."""
+    key = None if proxies is None else tuple(sorted(proxies.items()))
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter_class = HTTPAdapter
+            if proxies is not None:
+                session.proxies = proxies
+                adapter_class = HTTPAdapterWithProxyKerberosAuth
+            for prefix in ('http://', 'https://'):
+                session.mount(prefix, adapter_class(
+                    pool_connections=32,
+                    pool_maxsize=32,
+                    max_retries=Retry(total=3, backoff_factor=0.3),
+                ))
+            _SESSIONS[key] = session
+        return session
+
 class GoogleSheetDownloader:
     """Class để tải và xử lý Google Sheet từ URL công khai, lưu dữ liệu và màu nền vào file Excel."""
 
-    def __init__(self, spreadsheet_id: str, html_url: str, gid: str, proxies: Optional[dict] = None):
+    def __init__(self, spreadsheet_id: str, html_url: str, gid: str, proxies: Optional[dict] = None,
+                 session: Optional[requests.Session] = None):
         """
         Khởi tạo với ID của Google Sheet và worksheet.
 
@@ -34,22 +70,20 @@ class GoogleSheetDownloader:
             html_url: URL HTML công khai của sheet (nếu có).
             gid: ID của worksheet.
             proxies: Dictionary chứa cấu hình proxy (nếu có).
+            session: Session dùng để tải (mặc định là session dùng chung theo `proxies`).
         """
         self.spreadsheet_id = spreadsheet_id
         self.gid = gid
         self.html_url = html_url
-        session = requests.Session()
-        if proxies is not None:
-            session.proxies = proxies
-            session.mount('http://', HTTPAdapterWithProxyKerberosAuth())
-            session.mount('https://', HTTPAdapterWithProxyKerberosAuth())
-        self.session = session
+        self.session = session or get_shared_session(proxies)
+        # SHA-1 của nội dung HTML lần tải gần nhất (None nếu chưa tải)
+        self.content_sha: Optional[str] = None
 
-    def fetch_html(self) -> Tuple[str, str]:
-        """Tải nội dung HTML từ Google Sheet qua /htmlview.
+    def fetch_html(self) -> Tuple[str, lxml.html.HtmlElement]:
+        """Tải HTML từ Google Sheet qua /htmlview và parse dần từng chunk trong lúc tải.
 
         Returns:
-            Nội dung HTML của sheet.
+            Tuple chứa URL đã tải và cây HTML đã parse.
 
         Raises:
             Exception: Nếu không thể truy cập sheet hoặc lỗi mạng.
@@ -57,97 +91,92 @@ class GoogleSheetDownloader:
         html_url = self.html_url or f'https://docs.google.com/spreadsheets/d/{self.spreadsheet_id}/htmlview'
         logger.info(f"Tải HTML từ: {html_url}")
         try:
-            response = self.session.get(html_url, verify=False)
-            response.raise_for_status()
-            return html_url, response.text
+            with self.session.get(html_url, verify=False, stream=True) as response:
+                response.raise_for_status()
+                parser = lxml.html.HTMLParser(encoding=response.encoding or 'utf-8')
+                digest = hashlib.sha1(usedforsecurity=False)
+                for chunk in response.iter_content(chunk_size=65536):
+                    digest.update(chunk)
+                    parser.feed(chunk)
+                self.content_sha = digest.hexdigest()
+                return html_url, parser.close()
         except Exception as e:
             logger.error(f"Lỗi khi tải HTML: {e}")
             raise Exception(f"Lỗi khi tải HTML: {e}")
 
-    def extract_css_colors(self, soup: BeautifulSoup) -> dict:
-        """Trích xuất màu nền từ CSS classes trong thẻ <style>.
+    def extract_css_colors(self, css_content: str) -> dict:
+        """Trích xuất màu nền từ các CSS class `.ritz .waffle .sN` bằng regex trên nội dung CSS.
 
         Args:
-            soup: Đối tượng BeautifulSoup chứa HTML.
+            css_content: Nội dung các thẻ <style> của sheet.
 
         Returns:
             Dictionary ánh xạ CSS class sang mã màu hex.
         """
         css_colors = {}
-        style_tag = soup.find('style')
-        if not style_tag:
-            logger.warning("Không tìm thấy thẻ <style> trong HTML.")
-            return css_colors
-
-        css_content = style_tag.get_text()
-        pattern = r'\.ritz\s*\.waffle\s*\.s(\d+)\s*\{[^}]*background-color:\s*([^;]+);'
-        matches = re.findall(pattern, css_content)
-
-        for class_id, color in matches:
-            color = color.strip()
+        for match in _CSS_COLOR_RE.finditer(css_content):
+            class_id, color = match.group(1), match.group(2).strip()
             if color.startswith('rgb'):
-                rgb = [int(x) for x in re.findall(r'\d+', color)]
+                rgb = [int(x) for x in _RGB_RE.findall(color)]
                 color = f"{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}"
             css_colors[f's{class_id}'] = color
 
+        if not css_colors:
+            logger.warning("Không tìm thấy màu nền nào trong CSS của HTML.")
+
         logger.info(f"Đã trích xuất {len(css_colors)} màu nền từ CSS")
         return css_colors
 
-    def parse_html_to_data(self, html_content: str) -> Tuple[List[List[str]], List[List[str]]]:
+    def parse_html_to_data(self, root: lxml.html.HtmlElement) -> Tuple[np.ndarray, np.ndarray]:
         """Parse HTML để lấy dữ liệu bảng và màu nền từ div có id khớp với gid.
 
         Args:
-            html_content: Nội dung HTML của sheet.
+            root: Cây HTML của sheet đã được parse bởi fetch_html.
 
         Returns:
-            Tuple chứa danh sách dữ liệu và danh sách màu nền.
+            Tuple chứa mảng dữ liệu và mảng màu nền (2 chiều, dtype object).
 
         Raises:
             Exception: Nếu không tìm thấy div, bảng hoặc dữ liệu.
         """
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
-            css_colors = self.extract_css_colors(soup)
+            css_colors = self.extract_css_colors(''.join(style.text_content() for style in root.iter('style')))
 
-            div = soup.find('div', id=self.gid)
-            if not div:
+            divs = root.xpath('//div[@id=$gid]', gid=self.gid)
+            if not divs:
                 raise Exception(f"Không tìm thấy div với id={self.gid} trong HTML.")
 
-            table = div.find('table')
-            if not table:
+            table = divs[0].find('.//table')
+            if table is None:
                 raise Exception(f"Không tìm thấy bảng dữ liệu trong div với id={self.gid}.")
 
-            rows = table.find_all('tr')
+            rows = table.xpath('.//tr')
             if not rows:
                 raise Exception("Không có hàng nào trong bảng.")
 
+            row_cells = [row.xpath('.//td|.//th') for row in rows]
             max_cols = max(
-                sum(int(cell.get('colspan', 1)) for cell in row.find_all(['td', 'th']))
-                for row in rows
+                sum(int(cell.get('colspan', 1)) for cell in cells)
+                for cells in row_cells
             )
 
-            data_grid = []
-            color_grid = []
+            # Cấp phát sẵn lưới (số hàng, số cột); None đánh dấu ô chưa được điền
+            data_grid = np.full((len(rows), max_cols), None, dtype=object)
+            color_grid = np.full((len(rows), max_cols), None, dtype=object)
             merged_count = 0
-            row_idx = 0
-
-            for row in rows:
-                while len(data_grid) <= row_idx:
-                    data_grid.append([None] * max_cols)
-                    color_grid.append([None] * max_cols)
 
+            for row_idx, cells in enumerate(row_cells):
                 col_idx = 0
-                cells = row.find_all(['td', 'th'])
 
                 for cell in cells:
-                    while col_idx < max_cols and data_grid[row_idx][col_idx] is not None:
+                    while col_idx < max_cols and data_grid[row_idx, col_idx] is not None:
                         col_idx += 1
 
                     rowspan = int(cell.get('rowspan', 1))
                     colspan = int(cell.get('colspan', 1))
-                    cell_text = cell.get_text(strip=True)
+                    cell_text = ''.join(text.strip() for text in cell.itertext())
 
-                    classes = cell.get('class', [])
+                    classes = (cell.get('class') or '').split()
                     if 'freezebar-cell' in classes:
                         continue
                     bg_color = ''
@@ -161,26 +190,20 @@ class GoogleSheetDownloader:
                         merged_count += 1
 
                     # Chỉ đặt giá trị cho ô đầu tiên, các ô khác để trống
-                    for r in range(row_idx, min(row_idx + rowspan, len(rows))):
-                        while len(data_grid) <= r:
-                            data_grid.append([None] * max_cols)
-                            color_grid.append([None] * max_cols)
-
-                        for c in range(col_idx, min(col_idx + colspan, max_cols)):
-                            if r == row_idx and c == col_idx:
-                                data_grid[r][c] = cell_text
-                            else:
-                                data_grid[r][c] = ''
-                            color_grid[r][c] = bg_color
+                    if col_idx < max_cols:
+                        merged_area = (slice(row_idx, row_idx + rowspan), slice(col_idx, col_idx + colspan))
+                        data_grid[merged_area] = ''
+                        data_grid[row_idx, col_idx] = cell_text
+                        color_grid[merged_area] = bg_color
 
                     col_idx += colspan
 
-                row_idx += 1
+            filled = np.not_equal(data_grid, None)
+            kept_rows = filled.any(axis=1)
+            data = np.where(filled, data_grid, '')[kept_rows]
+            colors = np.where(filled, color_grid, '')[kept_rows]
 
-            data = [[cell if cell is not None else '' for cell in row] for row in data_grid if any(cell is not None for cell in row)]
-            colors = [[cell if cell is not None else '' for cell in row] for row in color_grid if any(cell is not None for cell in row)]
-
-            if not data:
+            if len(data) == 0:
                 raise Exception("Không có dữ liệu nào được lấy từ sheet.")
 
             logger.info(f"Đã xử lý {merged_count} vùng merged cells trong bảng")
@@ -189,12 +212,12 @@ class GoogleSheetDownloader:
             logger.error(f"Lỗi khi parse HTML: {e}")
             raise Exception(f"Lỗi khi parse HTML: {e}")
 
-    def process_data(self, data: List[List[str]], colors: List[List[str]]) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    def process_data(self, data: np.ndarray, colors: np.ndarray) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
         """Xử lý dữ liệu và màu: bỏ hàng 1, cột 1, giữ nguyên các hàng rỗng ở giữa.
 
         Args:
-            data: Danh sách dữ liệu từ HTML.
-            colors: Danh sách màu nền từ HTML.
+            data: Mảng dữ liệu từ HTML.
+            colors: Mảng màu nền từ HTML.
 
         Returns:
             Tuple chứa DataFrame dữ liệu và DataFrame màu nền.
@@ -219,8 +242,9 @@ class GoogleSheetDownloader:
                 return data_df, None
 
             # Thay thế chuỗi rỗng và khoảng trắng bằng np.nan, nhưng giữ nguyên cấu trúc
-            data_df = data_df.replace(r'^\s*$', np.nan, regex=True)
-            data_df = data_df.replace('', np.nan)
+            values = data_df.to_numpy(dtype=object, copy=True)
+            values[_is_blank(values).astype(bool)] = np.nan
+            data_df = pd.DataFrame(values, index=data_df.index, columns=data_df.columns)
 
             # Đồng bộ kích thước của color_df với data_df
             color_df = color_df.loc[:data_df.index[-1], :data_df.columns[-1]]
@@ -234,20 +258,25 @@ class GoogleSheetDownloader:
             logger.error(f"Lỗi khi xử lý dữ liệu: {e}")
             raise Exception(f"Lỗi khi xử lý dữ liệu: {e}")
 
-    def download(self) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame], str]:
+    def download(self, known_sha: Optional[str] = None) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame], str]:
         """
         Tải Google Sheet, xử lý, và trả về DataFrame dữ liệu, DataFrame màu sắc, và URL.
 
         Args:
-            return_df: Nếu True, sẽ trả về DataFrames thay vì lưu file.
+            known_sha: SHA-1 nội dung của lần tải trước; nếu nội dung tải về trùng khớp
+                thì bỏ qua bước phân tích và trả về (None, None, download_url).
 
         Returns:
             Một tuple chứa (data_df, color_df, download_url).
         """
         download_url = ''
         try:
-            download_url, html_content = self.fetch_html()
-            data, colors = self.parse_html_to_data(html_content)
+            download_url, root = self.fetch_html()
+            if known_sha is not None and self.content_sha == known_sha:
+                logger.info("Nội dung sheet không đổi so với lần tải trước, bỏ qua bước phân tích.")
+                return None, None, download_url
+
+            data, colors = self.parse_html_to_data(root)
             data_df, color_df = self.process_data(data, colors)
 
             if data_df is None:
@@ -259,3 +288,35 @@ class GoogleSheetDownloader:
         except Exception as e:
             logger.error(f"Lỗi khi tải và xử lý Google Sheet: {e}")
             return None, None, download_url
+
+    @classmethod
+    def download_many(cls, configs: List[Dict[str, Any]], proxies: Optional[dict] = None, max_workers: int = 8,
+                      known_shas: Optional[Dict[Any, str]] = None
+                      ) -> Iterator[Tuple[Dict[str, Any], Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame], str], Optional[str]]]:
+        """
+        Tải song song nhiều Google Sheet bằng một ThreadPoolExecutor có giới hạn.
+
+        Args:
+            configs: Danh sách cấu hình, mỗi cái có 'spreadsheet_id', 'html_url' và 'gid'.
+            proxies: Dictionary chứa cấu hình proxy (nếu có).
+            max_workers: Số luồng tải tối đa.
+            known_shas: SHA-1 nội dung đã biết theo config 'id'; sheet có nội dung trùng sẽ không được phân tích lại.
+
+        Yields:
+            Tuple (config, kết quả của download(), content_sha) theo thứ tự tải xong.
+        """
+        known_shas = known_shas or {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for config in configs:
+                downloader = cls(
+                    spreadsheet_id=config.get('spreadsheet_id'),
+                    html_url=config.get('html_url'),
+                    gid=config['gid'],
+                    proxies=proxies
+                )
+                future = executor.submit(downloader.download, known_shas.get(config.get('id')))
+                futures[future] = (config, downloader)
+            for future in as_completed(futures):
+                config, downloader = futures[future]
+                yield config, future.result(), downloader.content_sha
@@ -1,21 +1,35 @@
 import os
 import re
-import json
-import time
 import logging
+import numpy as np
 import pandas as pd
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from collections import defaultdict
 from django.conf import settings
 from pathlib import Path
 
 # Import các module đã được tùy chỉnh
-from .DatabaseManager import DatabaseManager
+from .DatabaseManager import ColMap, DatabaseManager
 from .GoogleSheetDownloader import GoogleSheetDownloader
 from .TelegramNotifier import TelegramNotifier
 
 logger = logging.getLogger(__name__)
 
+# Tổng thời gian cho phép gửi thông báo của một phiên: BASE + PER_RESULT giây cho mỗi nhóm kết quả
+NOTIFY_TIMEOUT_BASE = 30
+NOTIFY_TIMEOUT_PER_RESULT = 2
+
+# Mẫu mã căn hộ; có nhóm bắt để dùng với Series.str.extract
+_KEY_RE = re.compile(r'([A-Z0-9_.\-]+)')
+# Bỏ khoảng trắng, xuống dòng, dấu ngoặc; '&' và ',' được quy về '+'
+_NORM_TABLE = str.maketrans({' ': '', '\n': '', '(': '', ')': '', '&': '+', ',': '+'})
+
+
+def _normalize_column_name(name: Any) -> str:
+    """Chuẩn hóa tên cột (header hoặc alias) để so khớp."""
+    return str(name).strip().lower().translate(_NORM_TABLE).replace('và', '+')
+
+
 class InventoryScanner:
     """
     Quản lý luồng công việc chính: tải, so sánh, và thông báo dữ liệu
@@ -35,15 +49,21 @@ class InventoryScanner:
         else:
             self.notifier = None
             logger.warning("Không có BOT_TOKEN, sẽ không có thông báo nào được gửi.")
+        # config_id -> (SHA-1 nội dung sheet, dấu vân tay cấu hình) của snapshot đã lưu gần nhất
+        self._content_state: Dict[int, Tuple[str, Any]] = {}
+
+    def _config_fingerprint(self, config: dict) -> Any:
+        """Giá trị đại diện cho cấu hình và column mappings của dự án, dùng để phát hiện cấu hình thay đổi."""
+        return tuple(sorted(config.items())), tuple(self.db_manager.get_column_mappings(config['id']))
 
-    def _find_header_and_columns(self, df: pd.DataFrame, config: dict, mappings: List[Dict]) -> Optional[Dict[str, Any]]:
+    def _find_header_and_columns(self, df: pd.DataFrame, config: dict, mappings: List[ColMap]) -> Optional[Dict[str, Any]]:
         """
         Tự động tìm hàng header và vị trí của tất cả các cột được định nghĩa trong danh sách `mappings`.
 
         Args:
             df: DataFrame chứa dữ liệu từ file nguồn.
             config: Dictionary chứa thông tin cấu hình của dự án.
-            mappings: Danh sách các dictionary, mỗi cái chứa thông tin của một ColumnMapping.
+            mappings: Danh sách ColMap, mỗi phần tử chứa thông tin của một ColumnMapping.
 
         Returns:
             Một dictionary chứa thông tin về header và vị trí các cột, hoặc None nếu thất bại.
@@ -52,7 +72,7 @@ class InventoryScanner:
             logger.error(f"Dự án {config['project_name']} không có cấu hình cột (column mappings) nào.")
             return None
 
-        identifier_map = next((m for m in mappings if m.get('is_identifier')), None)
+        identifier_map = next((m for m in mappings if m.is_identifier), None)
         if not identifier_map:
             logger.error(f"Dự án {config['project_name']} không có cột nào được đánh dấu là 'is_identifier: true'.")
             return None
@@ -62,51 +82,43 @@ class InventoryScanner:
         if config_header_idx and 0 < int(config_header_idx) <= len(df):
             header_row_idx = int(config_header_idx) - 1
         else:
-            try:
-                identifier_aliases = {str(alias).lower() for alias in json.loads(identifier_map.get('aliases', '[]'))}
-                if not identifier_aliases:
-                    logger.error(f"Cột định danh '{identifier_map['internal_name']}' không có 'aliases' nào được cấu hình.")
-                    return None
-
-                for i, row in df.head(10).iterrows():
-                    row_values = {str(val).strip().lower() for val in row.dropna().values}
-                    if not identifier_aliases.isdisjoint(row_values):
-                        header_row_idx = i
-                        break
-            except json.JSONDecodeError:
+            if identifier_map.aliases is None:
                 logger.error(f"Lỗi JSON trong 'aliases' của cột định danh cho dự án {config['project_name']}.")
                 return None
 
+            identifier_aliases = {str(alias).lower() for alias in identifier_map.aliases}
+            if not identifier_aliases:
+                logger.error(f"Cột định danh '{identifier_map.internal_name}' không có 'aliases' nào được cấu hình.")
+                return None
+
+            # Tìm trong 10 hàng đầu hàng đầu tiên có ô (không rỗng) trùng một alias của cột định danh
+            head = df.head(10)
+            normalized_head = head.astype(str).apply(lambda column: column.str.strip().str.lower())
+            row_hits = (head.notna() & normalized_head.isin(list(identifier_aliases))).any(axis=1)
+            if row_hits.any():
+                header_row_idx = row_hits.index[int(np.argmax(row_hits.to_numpy()))]
+
         if header_row_idx == -1:
             logger.error(f"Không thể tự động tìm thấy hàng header cho dự án {config['project_name']}.")
             return None
 
-        def normalize_column_name(name: str):
-            normalized_name = str(name).strip().lower() \
-                .replace(' ', '').replace('\n', '').replace(')', '').replace('(', '') \
-                .replace('&', '+').replace('và', '+').replace(',', '+')
-            return normalized_name
-
-        header_content = [normalize_column_name(h) for h in df.iloc[header_row_idx].tolist()]
+        header_content = [_normalize_column_name(h) for h in df.iloc[header_row_idx].tolist()]
+        # Vị trí xuất hiện đầu tiên của mỗi tên cột đã chuẩn hóa
+        header_pos = {}
+        for pos, name in enumerate(header_content):
+            header_pos.setdefault(name, pos)
 
         column_indices = {}
         for mapping in mappings:
-            internal_key = mapping['internal_name']
-            col_idx = None
-            try:
-                aliases = [normalize_column_name(alias) for alias in json.loads(mapping.get('aliases', '[]'))]
-                for alias in aliases:
-                    try:
-                        col_idx = header_content.index(alias)
-                        break
-                    except ValueError:
-                        continue
-                column_indices[internal_key] = col_idx
-            except json.JSONDecodeError:
+            internal_key = mapping.internal_name
+            if mapping.aliases is None:
                 logger.error(f"Lỗi JSON trong 'aliases' của cột '{internal_key}' cho dự án {config['project_name']}.")
                 column_indices[internal_key] = None
+                continue
+            aliases = [_normalize_column_name(alias) for alias in mapping.aliases]
+            column_indices[internal_key] = next((header_pos[alias] for alias in aliases if alias in header_pos), None)
 
-        identifier_key_name = identifier_map['internal_name']
+        identifier_key_name = identifier_map.internal_name
         if column_indices.get(identifier_key_name) is None:
             logger.error(f"Không tìm thấy cột định danh '{identifier_key_name}' trong header của dự án {config['project_name']}.")
             return None
@@ -120,17 +132,24 @@ class InventoryScanner:
             "header": header_content
         }
 
-    def _normalize_and_validate_key(self, key: Any, prefixes: Optional[List[str]]) -> Optional[str]:
-        if not isinstance(key, (str, int, float)): return None
-        match = re.search(r'[A-Z0-9_.\-]+', str(key).strip().upper())
-        if not match: return None
-        clean_key = match.group(0)
-        if len(clean_key) < 5: return None
-        if not prefixes: return clean_key
-        for prefix in prefixes:
-            if clean_key.startswith(prefix.upper()):
-                return clean_key
-        return None
+    def _normalize_and_validate_keys(self, raw_keys: np.ndarray, prefixes: Optional[Tuple[str, ...]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Chuẩn hóa và kiểm tra toàn bộ cột định danh: lấy đoạn mã đầu tiên (viết hoa), tối thiểu 5 ký tự
+        và bắt đầu bằng một trong các tiền tố hợp lệ.
+
+        Args:
+            raw_keys: Mảng giá trị thô của cột định danh.
+            prefixes: Tuple tiền tố hợp lệ đã viết hoa (None hoặc rỗng để chấp nhận mọi key).
+
+        Returns:
+            Tuple (mảng key đã chuẩn hóa, mặt nạ boolean các key hợp lệ).
+        """
+        clean_keys = pd.Series(raw_keys, dtype=object).astype(str).str.strip().str.upper() \
+            .str.extract(_KEY_RE, expand=False)
+        mask = clean_keys.str.len() >= 5
+        if prefixes:
+            mask &= clean_keys.str.startswith(prefixes, na=False)
+        return clean_keys.to_numpy(dtype=object), mask.to_numpy(dtype=bool)
 
     def _extract_snapshot_data(self, data_df: pd.DataFrame, color_df: pd.DataFrame, header_info: dict, config: dict) -> Dict[str, Any]:
         """
@@ -141,69 +160,76 @@ class InventoryScanner:
         column_indices = header_info['column_indices']
         identifier_col_idx = column_indices[identifier_key]
 
-        invalid_colors_json = config.get('invalid_colors', '[]')
-        invalid_colors = {c.lower() for c in json.loads(invalid_colors_json)}
+        invalid_colors = config['invalid_colors_set']
 
         data_rows_df = data_df.iloc[header_info['header_row_idx'] + 1:]
         color_rows_df = color_df.iloc[header_info['header_row_idx'] + 1:]
 
-        prefixes_json = config.get('key_prefixes')
-        valid_prefixes = json.loads(prefixes_json) if prefixes_json else None
-
-        for index, row in data_rows_df.iterrows():
-            raw_key = row.iloc[identifier_col_idx]
-            valid_key = self._normalize_and_validate_key(raw_key, valid_prefixes)
-            logger.info(f"Đang xử lý key: {raw_key} -> {valid_key}")
-
-            if valid_key:
-                try:
-                    cell_color = color_rows_df.loc[index].iloc[identifier_col_idx]
-                    if cell_color and cell_color.lower() in invalid_colors:
-                        logger.info(f"Bỏ qua key '{valid_key}' do có màu không hợp lệ: {cell_color}")
-                        continue
-                except (KeyError, IndexError):
-                    pass
-
-                row_data = {}
-                for key, col_idx in column_indices.items():
-                    if key == identifier_key or col_idx is None:
-                        continue
-
-                    value = row.iloc[col_idx]
-                    row_data[key] = str(value) if pd.notna(value) else None
+        valid_prefixes = config['key_prefixes_upper']
 
-                snapshot_data[valid_key] = row_data
+        # Lấy trước các cột cần thiết dưới dạng mảng NumPy, tránh tạo Series cho từng hàng
+        value_columns = [(key, col_idx) for key, col_idx in column_indices.items()
+                         if key != identifier_key and col_idx is not None]
+        value_keys = [key for key, _ in value_columns]
+        raw_keys = data_rows_df.iloc[:, identifier_col_idx].to_numpy(dtype=object)
+        # Màu của cột định danh, căn theo vị trí với các hàng dữ liệu (ô thiếu màu coi như rỗng)
+        if identifier_col_idx < color_rows_df.shape[1]:
+            key_colors = color_rows_df.iloc[:, identifier_col_idx].reindex(data_rows_df.index, fill_value='').to_numpy(dtype=object)
+        else:
+            key_colors = np.full(len(data_rows_df), '', dtype=object)
+        value_rows = data_rows_df.iloc[:, [col_idx for _, col_idx in value_columns]].to_numpy(dtype=object)
+
+        clean_keys, valid_mask = self._normalize_and_validate_keys(raw_keys, valid_prefixes)
+        # Loại các hàng có màu nền không hợp lệ ở cột định danh (ô không màu luôn được giữ)
+        if invalid_colors:
+            lower_colors = pd.Series(key_colors, dtype=object).str.lower()
+            color_mask = (key_colors != '') & lower_colors.isin(invalid_colors).to_numpy(dtype=bool)
+            logger.debug("Bỏ qua %s key do có màu không hợp lệ.", int((valid_mask & color_mask).sum()))
+            valid_mask &= ~color_mask
+        logger.debug("Có %s/%s key hợp lệ.", int(valid_mask.sum()), len(valid_mask))
+
+        # Ô trống (NaN) được lưu là None, các ô còn lại là chuỗi
+        selected_values = value_rows[valid_mask]
+        missing = pd.isna(selected_values)
+        for valid_key, values, is_missing in zip(clean_keys[valid_mask], selected_values, missing):
+            snapshot_data[valid_key] = {
+                key: None if value_missing else str(value)
+                for key, value, value_missing in zip(value_keys, values, is_missing)
+            }
 
         return snapshot_data
 
-    def _compare_snapshots(self, new_snapshot: Dict, old_snapshot: Dict) -> Dict[str, List]:
+    def _compare_snapshots(self, new_snapshot: Dict, old_snapshot: Dict, fields: Optional[Tuple[str, ...]] = None) -> Dict[str, List]:
         """
         So sánh hai snapshot, bao gồm tất cả các trường dữ liệu (price, policy, v.v.).
+
+        Args:
+            new_snapshot: Snapshot mới trích xuất.
+            old_snapshot: Snapshot gần nhất đã lưu.
+            fields: Các trường cần so sánh; nếu None, so sánh hợp các trường của từng căn.
+
+        Returns:
+            Dictionary gồm danh sách key 'added', 'removed' và các thay đổi 'changed'.
         """
-        new_keys = set(new_snapshot.keys())
-        old_keys = set(old_snapshot.keys())
+        new_keys = new_snapshot.keys()
+        old_keys = old_snapshot.keys()
 
-        added = sorted(list(new_keys - old_keys))
-        removed = sorted(list(old_keys - new_keys))
+        added = sorted(new_keys - old_keys)
+        removed = sorted(old_keys - new_keys)
 
         changed = []
-        common_keys = new_keys.intersection(old_keys)
-        for key in common_keys:
-            old_data = old_snapshot.get(key, {})
-            new_data = new_snapshot.get(key, {})
-
-            all_fields = set(old_data.keys()) | set(new_data.keys())
+        for key in new_keys & old_keys:
+            old_data = old_snapshot[key]
+            new_data = new_snapshot[key]
+            # Phần lớn các căn không đổi giữa hai lần quét: so sánh cả dict (ở tầng C) trước
+            if new_data == old_data:
+                continue
 
-            for field in all_fields:
+            for field in (fields if fields is not None else old_data.keys() | new_data.keys()):
                 old_value = old_data.get(field)
                 new_value = new_data.get(field)
 
-                old_is_nan = pd.isna(old_value)
-                new_is_nan = pd.isna(new_value)
-
-                if old_is_nan and new_is_nan:
-                    continue
-
+                # Giá trị trong snapshot chỉ là chuỗi hoặc None (ô trống), nên so sánh trực tiếp là đủ
                 if old_value != new_value:
                     changed.append({
                         "key": key,
@@ -214,6 +240,70 @@ class InventoryScanner:
 
         return {'added': added, 'removed': removed, 'changed': changed}
 
+    def _process_config(self, config: dict, download_result: Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame], str]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        Xử lý một cấu hình đã tải xong: xác định header, trích xuất snapshot và so sánh với snapshot cũ.
+
+        Args:
+            config: Dictionary chứa thông tin cấu hình của dự án.
+            download_result: Tuple (data_df, color_df, download_url) trả về từ GoogleSheetDownloader.
+
+        Returns:
+            Tuple (kết quả so sánh nếu có thay đổi hoặc None, snapshot mới để lưu hoặc None nếu lỗi).
+        """
+        agent_name = config['agent_name']
+        project_name = config['project_name']
+        config_id = config['id']
+
+        logger.info(f"▶️  Đang xử lý: {agent_name} - {project_name} (ID: {config_id})")
+
+        try:
+            mappings = self.db_manager.get_column_mappings(config_id)
+            current_df, color_df, download_url = download_result
+
+            if current_df is None or color_df is None or current_df.empty:
+                logger.error(f"Không tải được dữ liệu hoặc màu sắc cho ID {config_id}.")
+                return None, None
+
+            header_info = self._find_header_and_columns(current_df, config, mappings)
+            if not header_info:
+                logger.error(f"Không xác định được header/cột cho ID {config_id}.")
+                return None, None
+
+            new_snapshot = self._extract_snapshot_data(current_df, color_df, header_info, config)
+
+            old_snapshot = self.db_manager.get_latest_snapshot(config_id)
+
+            if old_snapshot is not None:
+                # Mọi căn trong một snapshot có cùng tập trường: các cột đã ánh xạ của lần quét này,
+                # cộng thêm các trường chỉ còn trong snapshot cũ (khi cấu hình cột vừa thay đổi)
+                column_indices = header_info['column_indices']
+                current_fields = [key for key, col_idx in column_indices.items()
+                                  if key != header_info['identifier_key'] and col_idx is not None]
+                old_fields = next(iter(old_snapshot.values()), {}).keys()
+                fields = tuple(dict.fromkeys([*current_fields, *old_fields]))
+                comparison = self._compare_snapshots(new_snapshot, old_snapshot, fields)
+                logger.info(f"    -> So sánh hoàn tất: {len(comparison['added'])} thêm, {len(comparison['removed'])} bán, {len(comparison['changed'])} đổi.")
+            else:
+                comparison = {'added': list(new_snapshot.keys()), 'removed': [], 'changed': []}
+                logger.info("    -> Lần đầu chạy, ghi nhận toàn bộ là căn mới.")
+
+            result = None
+            if comparison.get('added') or comparison.get('removed') or comparison.get('changed'):
+                result = {
+                    'agent_name': agent_name,
+                    'project_name': project_name,
+                    'telegram_chat_id': config['telegram_chat_id'],
+                    'comparison': comparison
+                }
+
+            logger.info(f"    -> Đã ghi nhận snapshot mới với {len(new_snapshot)} keys.")
+            return result, new_snapshot
+
+        except Exception as e:
+            logger.exception(f"Lỗi nghiêm trọng khi xử lý cấu hình ID {config_id}: {e}")
+            return None, None
+
     def run(self):
         logger.info("="*50)
         logger.info("BẮT ĐẦU PHIÊN LÀM VIỆC MỚI")
@@ -223,77 +313,70 @@ class InventoryScanner:
             logger.warning("Không có cấu hình nào đang hoạt động trong database. Kết thúc.")
             return
 
-        all_individual_results = []
-        for config_row in active_configs:
-            config = dict(config_row)
-            agent_name = config['agent_name']
-            project_name = config['project_name']
+        configs = [dict(config_row) for config_row in active_configs]
+
+        # Sheet có nội dung (và cấu hình cột) giống hệt lần lưu snapshot trước thì không cần phân tích lại
+        fingerprints = {config['id']: self._config_fingerprint(config) for config in configs}
+        known_shas = {}
+        for config_id, fingerprint in fingerprints.items():
+            state = self._content_state.get(config_id)
+            if state and state[1] == fingerprint:
+                known_shas[config_id] = state[0]
+
+        # Tải song song các sheet (I/O mạng); mỗi sheet tải xong được xử lý ngay ở luồng chính
+        # trong khi các sheet khác vẫn đang tải. Đọc/ghi database chỉ diễn ra ở luồng chính.
+        logger.info(f"⬇️  Đang tải {len(configs)} sheet...")
+        results_by_id = {}
+        snapshots_by_id = {}
+        content_shas = {}
+        unchanged_ids = []
+        for config, download_result, content_sha in GoogleSheetDownloader.download_many(
+                configs, proxies=self.proxies, known_shas=known_shas):
             config_id = config['id']
+            if content_sha is not None and known_shas.get(config_id) == content_sha:
+                logger.info(f"⏭️  Bỏ qua: {config['agent_name']} - {config['project_name']} (ID: {config_id}), nội dung sheet không đổi.")
+                unchanged_ids.append(config_id)
+                continue
 
-            print("="*20)
-            print(f"▶️  Đang xử lý: {agent_name} - {project_name} (ID: {config_id})")
-
-            try:
-                mappings = self.db_manager.get_column_mappings(config_id)
-                downloader = GoogleSheetDownloader(
-                    spreadsheet_id=config.get('spreadsheet_id'),
-                    html_url=config.get('html_url'),
-                    gid=config['gid'],
-                    proxies=self.proxies
-                )
-                current_df, color_df, download_url = downloader.download()
-
-                if current_df is None or color_df is None or current_df.empty:
-                    logger.error(f"Không tải được dữ liệu hoặc màu sắc cho ID {config_id}.")
-                    continue
-
-                header_info = self._find_header_and_columns(current_df, config, mappings)
-                if not header_info:
-                    logger.error(f"Không xác định được header/cột cho ID {config_id}.")
-                    continue
-
-                new_snapshot = self._extract_snapshot_data(current_df, color_df, header_info, config)
-
-                old_snapshot = self.db_manager.get_latest_snapshot(config_id)
-
-                if old_snapshot is not None:
-                    comparison = self._compare_snapshots(new_snapshot, old_snapshot)
-                    print(f"    -> So sánh hoàn tất: {len(comparison['added'])} thêm, {len(comparison['removed'])} bán, {len(comparison['changed'])} đổi.")
-                else:
-                    comparison = {'added': list(new_snapshot.keys()), 'removed': [], 'changed': []}
-                    print("    -> Lần đầu chạy, ghi nhận toàn bộ là căn mới.")
-
-                if comparison.get('added') or comparison.get('removed') or comparison.get('changed'):
-                    all_individual_results.append({
-                        'agent_name': agent_name,
-                        'project_name': project_name,
-                        'telegram_chat_id': config['telegram_chat_id'],
-                        'comparison': comparison
-                    })
-
-                self.db_manager.add_snapshot(config_id, new_snapshot)
-                print(f"    -> Đã lưu snapshot mới với {len(new_snapshot)} keys.")
-
-            except Exception as e:
-                logger.exception(f"Lỗi nghiêm trọng khi xử lý cấu hình ID {config_id}: {e}")
-                print(f"    ❌ Lỗi: {e}. Kiểm tra runtime.log để biết chi tiết.")
-
-        print("="*20)
-        print("🔄 Đang tổng hợp và gom nhóm kết quả...")
-        aggregated_results = defaultdict(lambda: {'added': [], 'removed': [], 'changed': [], 'telegram_chat_id': None})
+            result, new_snapshot = self._process_config(config, download_result)
+            if result is not None:
+                results_by_id[config_id] = result
+            if new_snapshot is not None:
+                snapshots_by_id[config_id] = new_snapshot
+                content_shas[config_id] = content_sha
+
+        # Giữ thứ tự cấu hình cho việc gom nhóm và ghi snapshot, bất kể thứ tự tải xong
+        all_individual_results = [results_by_id[c['id']] for c in configs if c['id'] in results_by_id]
+        pending_snapshots = [(c['id'], snapshots_by_id[c['id']]) for c in configs if c['id'] in snapshots_by_id]
+
+        # Lưu tất cả snapshot của phiên trong một transaction; chỉ ghi nhớ nội dung đã lưu thành công
+        snapshots_saved = self.db_manager.add_snapshots(pending_snapshots)
+        if snapshots_saved:
+            for config_id, _ in pending_snapshots:
+                if content_shas[config_id] is not None:
+                    self._content_state[config_id] = (content_shas[config_id], fingerprints[config_id])
+        # Sheet không đổi không ghi snapshot mới: làm mới snapshot gần nhất để nó không bị dọn dẹp
+        self.db_manager.touch_latest_snapshots(unchanged_ids)
+
+        logger.info("🔄 Đang tổng hợp và gom nhóm kết quả...")
+        # Dùng dict làm tập có thứ tự: gộp và loại trùng trong một lần duyệt
+        # ('changed' loại trùng theo (key, field), giữ thay đổi gặp đầu tiên)
+        aggregated_results = defaultdict(lambda: {'added': {}, 'removed': {}, 'changed': {}, 'telegram_chat_id': None})
 
         for result in all_individual_results:
             key = (result['agent_name'], result['project_name'])
+            group = aggregated_results[key]
 
-            aggregated_results[key]['added'].extend(result['comparison']['added'])
-            aggregated_results[key]['removed'].extend(result['comparison']['removed'])
-            aggregated_results[key]['changed'].extend(result['comparison']['changed'])
-            if not aggregated_results[key]['telegram_chat_id']:
-                aggregated_results[key]['telegram_chat_id'] = result['telegram_chat_id']
+            group['added'].update(dict.fromkeys(result['comparison']['added']))
+            group['removed'].update(dict.fromkeys(result['comparison']['removed']))
+            for change in result['comparison']['changed']:
+                group['changed'].setdefault((change['key'], change['field']), change)
+            if not group['telegram_chat_id']:
+                group['telegram_chat_id'] = result['telegram_chat_id']
 
-        print("🚀 Đang gửi các thông báo tổng hợp...")
+        logger.info("🚀 Đang gửi các thông báo tổng hợp...")
         if not self.notifier:
-            print("    -> Bỏ qua vì không có BOT_TOKEN.")
+            logger.info("    -> Bỏ qua vì không có BOT_TOKEN.")
             return
 
         for (agent_name, project_name), data in aggregated_results.items():
@@ -305,32 +388,43 @@ class InventoryScanner:
                 'agent_name': agent_name,
                 'project_name': project_name,
                 'comparison': {
-                    'added': data['added'],
-                    'removed': data['removed'],
-                    'changed': data['changed']
+                    'added': list(data['added']),
+                    'removed': list(data['removed']),
+                    'changed': list(data['changed'].values())
                 }
             }
 
             message = self.notifier.format_message(final_result_for_message)
 
             if message:
-                print(f"    -> Gửi thông báo cho: {agent_name} - {project_name}")
-                self.notifier.send_message(chat_id, message)
-                time.sleep(3)
+                logger.info(f"    -> Gửi thông báo cho: {agent_name} - {project_name}")
+                self.notifier.queue_message(chat_id, message)
 
+        # Các thông báo cùng chat được gộp thành ít tin nhất có thể; các chat khác nhau gửi đồng thời,
+        # notifier tự giãn cách và giới hạn tốc độ theo Telegram. Cả lần gửi có chung một hạn chót.
+        self.notifier.flush(timeout=NOTIFY_TIMEOUT_BASE + NOTIFY_TIMEOUT_PER_RESULT * len(aggregated_results))
+
+        logger.info("✅ Hoàn thành tất cả các tác vụ.")
+
+    def close(self):
+        """Giải phóng các tài nguyên (kết nối database, kết nối tới Telegram) của scanner."""
+        if self.notifier:
+            self.notifier.close()
         self.db_manager.close()
-        print("="*20)
-        print("✅ Hoàn thành tất cả các tác vụ.")
 
 
-if __name__ == "__main__":
+def main():
+    """Điểm vào khi chạy trực tiếp module: quét một lần rồi giải phóng tài nguyên."""
     bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    proxies = {
-        'http': 'http://rb-proxy-apac.bosch.com:8080',
-        'https': 'http://rb-proxy-apac.bosch.com:8080'
-    }
     if not bot_token:
         print("Lỗi: Vui lòng thiết lập biến môi trường TELEGRAM_BOT_TOKEN.")
-    else:
-        manager = InventoryScanner(bot_token=bot_token, proxies=None)
+        return
+    manager = InventoryScanner(bot_token=bot_token, proxies=None)
+    try:
         manager.run()
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,196 @@
 import os
+import re
 import time
+import functools
+import random
+import orjson
 import requests
 import logging
-from typing import Dict, Any, List
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from html import escape as _esc
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Giới hạn của Telegram: khoảng 30 tin/giây cho cả bot và 20 tin/phút cho mỗi nhóm
+GLOBAL_RATE_PER_SECOND = 25  # chừa khoảng trống so với giới hạn 30 tin/giây
+PER_CHAT_INTERVAL = 3  # số giây giữa hai tin liên tiếp gửi vào cùng một chat
+SENDER_THREADS = 8  # số luồng nền gửi tin nhắn
+REQUEST_TIMEOUT = 15  # timeout (giây) tối đa của một request sendMessage
+MAX_SEND_ATTEMPTS = 5  # số lần gửi tối đa khi Telegram trả lỗi tạm thời (429, 5xx)
+# Ngắt mạch theo chat: sau BREAKER_THRESHOLD lỗi 4xx liên tiếp (bot bị chặn, chat_id sai...)
+# thì bỏ qua chat đó trong BREAKER_COOLDOWN giây, rồi cho thử lại một lần
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 600
+# Độ dài tối đa của một tin gửi đi, chừa khoảng trống so với giới hạn 4096 ký tự của Telegram.
+# Tin dài hơn được tách thành nhiều tin; gộp tin (BATCH_LIMIT) dùng cùng giới hạn này
+_LIMIT = 4000
+# Gộp nhiều thông báo của cùng một chat thành một tin, không vượt quá _LIMIT
+BATCH_LIMIT = _LIMIT
+BATCH_SEPARATOR = '\n\n━━━\n\n'
+# Thẻ HTML và thực thể (&amp;, &#39;...) là các đơn vị không được cắt ngang khi tách tin
+_HTML_TOKEN_RE = re.compile(r'<[^>]*>|&#?\w+;|[^<&]+|[<&]')
+_HTML_TAG_RE = re.compile(r'<(/?)(\w+)[^>]*>')
+_TAG_HEADROOM = 200  # chỗ chừa cho các thẻ đóng/mở lại khi phải cắt bên trong một dòng
+
+# Nhãn cố định của tin nhắn thông báo
+_HDR_AGENT = "🏢 <b>Đại lý:</b>"
+_HDR_PROJECT = "📋 <b>Dự án:</b>"
+_HDR_ADDED = "➕ <b>Nhập thêm"
+_HDR_REMOVED = "✅ <b>Đã bán"
+_HDR_CHANGED = "✏️ <b>Thay đổi"
+# Số mục tối đa liệt kê trong mỗi phần của thông báo; phần còn lại chỉ ghi số lượng
+_MAX_ITEMS = 40
+
+def _retry_after(response: requests.Response) -> float:
+    """Số giây cần chờ theo header Retry-After của phản hồi 429 (mặc định 1 giây)."""
+    try:
+        return max(float(response.headers.get('Retry-After', 1)), 0)
+    except ValueError:
+        return 1
+
+def _update_open_tags(open_tags: List[str], piece: str) -> List[str]:
+    """Trả về ngăn xếp các thẻ mở (dạng chuỗi thẻ mở gốc) sau khi đi qua `piece`."""
+    open_tags = list(open_tags)
+    for match in _HTML_TAG_RE.finditer(piece):
+        if match.group(1):
+            if open_tags:
+                open_tags.pop()
+        elif not match.group(0).endswith('/>'):
+            open_tags.append(match.group(0))
+    return open_tags
+
+def _closing_tags(open_tags: List[str]) -> str:
+    """Chuỗi thẻ đóng cho các thẻ đang mở, theo thứ tự ngược."""
+    return "".join(f"</{_HTML_TAG_RE.match(tag).group(2)}>" for tag in reversed(open_tags))
+
+def _split_long_line(line: str, size: int) -> List[str]:
+    """Cắt một dòng quá dài thành các đoạn không quá `size` ký tự, không cắt ngang thẻ hay thực thể HTML."""
+    pieces = []
+    current = ''
+    for token in _HTML_TOKEN_RE.findall(line):
+        # Chỉ phần văn bản thuần mới được cắt giữa chừng
+        while token[0] not in '<&' and len(current) + len(token) > size:
+            cut = size - len(current)
+            current, token = current + token[:cut], token[cut:]
+            pieces.append(current)
+            current = ''
+        if current and len(current) + len(token) > size:
+            pieces.append(current)
+            current = ''
+        current += token
+    if current:
+        pieces.append(current)
+    return pieces
+
+def _split_message(text: str, limit: int = _LIMIT) -> List[str]:
+    """
+    Tách tin nhắn dài thành các phần không quá `limit` ký tự, ưu tiên cắt tại ranh giới dòng.
+
+    Các thẻ đang mở tại điểm cắt (<blockquote>, <b>...) được đóng ở cuối phần trước và mở lại
+    ở đầu phần sau, để mỗi phần vẫn là HTML hợp lệ. Dòng quá dài (hiếm gặp) được cắt tiếp bên trong
+    dòng, nhưng không bao giờ cắt ngang một thẻ hay thực thể HTML.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    # Các đơn vị ghép tin: (đoạn HTML, ký tự nối với đơn vị trước)
+    units = []
+    piece_size = max(1, limit - _TAG_HEADROOM)
+    for line_no, line in enumerate(text.split('\n')):
+        separator = '\n' if line_no else ''
+        if len(line) <= piece_size:
+            units.append((line, separator))
+        else:
+            for piece_no, piece in enumerate(_split_long_line(line, piece_size)):
+                units.append((piece, separator if piece_no == 0 else ''))
+
+    chunks = []
+    current = ''
+    has_content = False
+    open_tags: List[str] = []  # các thẻ còn mở ở cuối `current`
+    for piece, separator in units:
+        open_after = _update_open_tags(open_tags, piece)
+        if has_content and len(current) + len(separator) + len(piece) + len(_closing_tags(open_after)) > limit:
+            chunks.append(current + _closing_tags(open_tags))
+            current, separator, has_content = "".join(open_tags), '', False
+        current += separator + piece
+        has_content = has_content or bool(piece)
+        open_tags = open_after
+    chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+def _join_capped(lines: List[str], total: int) -> str:
+    """Nối các dòng đã bị cắt còn tối đa _MAX_ITEMS, thêm dòng tóm tắt số mục bị lược bớt."""
+    text = "\n".join(lines)
+    if total > len(lines):
+        text += f"\n… và {total - len(lines)} mã khác"
+    return text
+
+@functools.lru_cache(maxsize=512)
+def _format_cached(agent_name: str, project_name: str, added: Tuple[str, ...], removed: Tuple[str, ...],
+                   changed: Tuple[Tuple[str, Any, Any], ...]) -> str:
+    """Dựng nội dung tin nhắn thông báo; tham số là tuple để kết quả được cache theo nội dung so sánh."""
+    added = sorted(set(added))
+    removed = sorted(set(removed))
+
+    # Tin gửi với parse_mode HTML: mọi giá trị lấy từ sheet/DB đều phải escape, nếu không Telegram trả 400
+    parts = [f"{_HDR_AGENT} {_esc(agent_name)}\n", f"{_HDR_PROJECT} {_esc(project_name)}\n\n"]
+
+    if added:
+        added_str = _join_capped([f"<b>{_esc(key)}</b>" for key in added[:_MAX_ITEMS]], len(added))
+        parts.append(f"{_HDR_ADDED} ({len(added)}):</b>\n<blockquote>{added_str}</blockquote>\n\n")
+
+    if removed:
+        removed_str = _join_capped([f"<b>{_esc(key)}</b>" for key in removed[:_MAX_ITEMS]], len(removed))
+        parts.append(f"{_HDR_REMOVED} ({len(removed)}):</b>\n<blockquote>{removed_str}</blockquote>\n\n")
+
+    if changed:
+        changed_str = _join_capped([f"<b>{_esc(key)}</b>: {_esc(str(old))} → {_esc(str(new))}"
+                                    for key, old, new in changed[:_MAX_ITEMS]],
+                                   len(changed))
+        parts.append(f"{_HDR_CHANGED} ({len(changed)}):</b>\n<blockquote>{changed_str}</blockquote>")
+
+    return "".join(parts).strip()
+
+class _Deadline:
+    """Hạn chót chung (theo time.monotonic) cho một loạt thao tác gửi."""
+
+    def __init__(self, total: float):
+        self.expiry = time.monotonic() + total
+
+    def remaining(self) -> float:
+        """Số giây còn lại, tối thiểu 0.1 để dùng làm timeout."""
+        return max(0.1, self.expiry - time.monotonic())
+
+    def expired(self) -> bool:
+        """Còn dưới 0.5 giây thì coi như đã hết hạn."""
+        return self.expiry - time.monotonic() < 0.5
+
+class _TokenBucket:
+    """Token bucket an toàn luồng, giới hạn số lần gửi mỗi giây."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Chờ đến khi có token rồi lấy một token."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
 class TelegramNotifier:
     """Class để gửi tin nhắn và tài liệu đến một chat Telegram cụ thể."""
 
@@ -23,19 +208,49 @@ class TelegramNotifier:
         self.bot_token = bot_token
         self.proxies = proxies
         self.base_url = f"https://api.telegram.org/bot{self.bot_token}"
+        self._rate_limiter = _TokenBucket(GLOBAL_RATE_PER_SECOND)
+        # Giới hạn số request đang chờ phản hồi từ Telegram cùng lúc. Chỉ các luồng gửi nền mới post,
+        # nên mặc định (= SENDER_THREADS) không bao giờ chặn; giới hạn chỉ có tác dụng khi đặt
+        # TG_MAX_INFLIGHT nhỏ hơn SENDER_THREADS (giá trị lớn hơn bị quy về SENDER_THREADS).
+        max_inflight = int(os.getenv('TG_MAX_INFLIGHT', SENDER_THREADS))
+        self._inflight = threading.BoundedSemaphore(max(1, min(max_inflight, SENDER_THREADS)))
+
+        # Một Session dùng chung (keep-alive) để không phải bắt tay TCP/TLS lại cho mỗi tin nhắn
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+        if proxies:
+            self._session.proxies.update(proxies)
+        self._session.headers['Content-Type'] = 'application/json'
+
+        # Các thông báo đang chờ gộp theo chat_id, và các tin đã gộp xong chờ flush()
+        self._pending: Dict[str, List[str]] = {}
+        self._pending_len: Dict[str, int] = {}
+        self._batched: List[Tuple[str, str]] = []
+
+        # Luồng gửi nền dùng lâu dài: flush() trả về ngay, close() chờ gửi hết
+        self._executor = ThreadPoolExecutor(max_workers=SENDER_THREADS, thread_name_prefix='telegram-sender')
+        self._chat_tail: Dict[str, Future] = {}  # lượt gửi mới nhất của mỗi chat, để giữ thứ tự
+        self._last_sent: Dict[str, float] = {}  # thời điểm (monotonic) gửi tin gần nhất của mỗi chat
+        self._breakers: Dict[str, Tuple[int, float]] = {}  # chat_id -> (số lỗi liên tiếp, mở mạch đến thời điểm)
 
-    def send_message(self, chat_id: str, message_text: str):
+    def send_message(self, chat_id: str, message_text: str, deadline: Optional['_Deadline'] = None):
         """
         Gửi một tin nhắn văn bản đến một chat_id cụ thể.
 
         Args:
             chat_id: ID của cuộc trò chuyện cần gửi tin nhắn đến.
             message_text: Nội dung tin nhắn. Hỗ trợ định dạng HTML.
+            deadline: Hạn chót chung của cả loạt gửi; timeout và thời gian chờ thử lại không vượt quá hạn này.
         """
         if not chat_id:
             logger.warning("chat_id trống, không thể gửi tin nhắn.")
             return
 
+        fail_count, open_until = self._breakers.get(chat_id, (0, 0.0))
+        if time.monotonic() < open_until:
+            logger.debug("Bỏ qua tin nhắn đến %s: mạch đang mở do lỗi liên tiếp.", chat_id)
+            return
+
         try:
             url = f"{self.base_url}/sendMessage"
             payload = {
@@ -44,54 +259,166 @@ class TelegramNotifier:
                 'parse_mode': 'HTML',
                 'disable_web_page_preview': True
             }
-            response = requests.post(url, json=payload, proxies=self.proxies, timeout=15)
+            # Tuần tự hóa một lần thành bytes cho mọi lần thử; Content-Type đã đặt sẵn trên session
+            body = orjson.dumps(payload)
+            # Chỉ thử lại với lỗi tạm thời (429, 5xx); các lỗi 4xx khác (token/chat_id sai) dừng ngay
+            for attempt in range(MAX_SEND_ATTEMPTS):
+                if deadline is not None and deadline.expired():
+                    logger.warning("Hết thời gian gửi thông báo, bỏ qua tin nhắn đến %s.", chat_id)
+                    return
+                timeout = REQUEST_TIMEOUT if deadline is None else min(REQUEST_TIMEOUT, deadline.remaining())
+                with self._inflight:
+                    response = self._session.post(url, data=body, timeout=timeout)
+                status = response.status_code
+                if status == 200:
+                    self._breakers.pop(chat_id, None)
+                    logger.debug("Đã gửi tin nhắn thành công đến chat_id %s.", chat_id)
+                    return
+                if attempt == MAX_SEND_ATTEMPTS - 1 or not (status == 429 or status >= 500):
+                    break
+                delay = _retry_after(response) if status == 429 else random.uniform(0, min(30, 0.5 * 2 ** attempt))
+                if deadline is not None and delay >= deadline.remaining():
+                    break
+                time.sleep(delay)
 
-            if response.status_code == 200:
-                logger.info(f"Đã gửi tin nhắn thành công đến chat_id {chat_id}.")
-            else:
-                logger.error(f"Lỗi khi gửi tin nhắn đến {chat_id}: {response.status_code} - {response.text}")
-                logger.error(f"Nội dung tin nhắn lỗi: {message_text[:200]}...")
+            logger.error("Lỗi khi gửi tin nhắn đến %s: %s - %s", chat_id, response.status_code, response.text)
+            logger.error("Nội dung tin nhắn lỗi: %.200s...", message_text)
+            if 400 <= status < 500 and status != 429:
+                self._record_failure(chat_id, fail_count)
 
         except requests.exceptions.RequestException as e:
-            logger.error(f"Lỗi RequestException khi gửi tin nhắn đến {chat_id}: {e}")
+            logger.error("Lỗi RequestException khi gửi tin nhắn đến %s: %s", chat_id, e)
         except Exception as e:
-            logger.error(f"Lỗi không xác định khi gửi tin nhắn: {e}")
+            logger.error("Lỗi không xác định khi gửi tin nhắn: %s", e)
 
-    def format_message(self, result: Dict[str, Any]) -> str:
+    def _record_failure(self, chat_id: str, fail_count: int):
+        """Ghi nhận một lỗi không thể thử lại của chat_id và mở mạch khi đạt ngưỡng."""
+        fail_count += 1
+        if fail_count >= BREAKER_THRESHOLD:
+            self._breakers[chat_id] = (fail_count, time.monotonic() + BREAKER_COOLDOWN)
+            logger.warning("Tạm ngừng gửi đến %s trong %s giây sau %s lỗi liên tiếp.", chat_id, BREAKER_COOLDOWN, fail_count)
+        else:
+            self._breakers[chat_id] = (fail_count, 0.0)
+
+    def send_messages(self, messages: List[Tuple[str, str]], wait: bool = True,
+                      deadline: Optional['_Deadline'] = None) -> List[Future]:
         """
-        Định dạng một tin nhắn chuẩn từ kết quả so sánh đã được gom nhóm.
+        Gửi nhiều tin nhắn song song trên các luồng gửi nền, trong giới hạn tốc độ của Telegram.
+
+        Các tin nhắn cùng chat_id được gửi tuần tự theo đúng thứ tự (kể cả giữa các lần gọi),
+        cách nhau ít nhất PER_CHAT_INTERVAL giây; các chat khác nhau được gửi đồng thời.
+
+        Args:
+            messages: Danh sách (chat_id, message_text).
+            wait: Nếu True, chờ đến khi tất cả tin nhắn được gửi xong.
+            deadline: Hạn chót chung cho cả loạt gửi; tin nhắn chưa gửi khi hết hạn sẽ bị bỏ qua.
+
+        Returns:
+            Danh sách Future của các lượt gửi (mỗi chat một Future).
         """
-        agent_name = result.get('agent_name', 'Không xác định')
-        project_name = result.get('project_name', 'Không xác định')
-        comparison = result.get('comparison', {})
+        messages_by_chat: Dict[str, List[str]] = {}
+        for chat_id, message_text in messages:
+            # Telegram trả 400 với tin quá 4096 ký tự: tách trước khi gửi thay vì gửi chắc chắn lỗi
+            chunks = _split_message(message_text)
+            if len(chunks) > 1:
+                logger.info("Tin nhắn đến %s dài %s ký tự, tách thành %s phần.", chat_id, len(message_text), len(chunks))
+            messages_by_chat.setdefault(chat_id, []).extend(chunks)
 
-        added = sorted(list(set(comparison.get('added', []))))
-        removed = sorted(list(set(comparison.get('removed', []))))
-        changed = comparison.get('changed', [])
+        futures = []
+        for chat_id, texts in messages_by_chat.items():
+            previous = self._chat_tail.get(chat_id)
+            future = self._executor.submit(self._send_chat, chat_id, texts, previous, deadline)
+            self._chat_tail[chat_id] = future
+            futures.append(future)
 
-        # Chỉ tạo tin nhắn nếu có ít nhất một thay đổi
-        if not added and not removed and not changed:
-            return ""
+        if wait:
+            for future in futures:
+                future.result()
+        return futures
 
-        message = f"🏢 <b>Đại lý:</b> {agent_name}\n"
-        message += f"📋 <b>Dự án:</b> {project_name}\n\n"
+    def _send_chat(self, chat_id: str, texts: List[str], previous: Optional[Future], deadline: Optional['_Deadline']):
+        """Gửi lần lượt các tin nhắn của một chat, sau khi lượt gửi trước của chat đó đã xong."""
+        if previous is not None:
+            previous.result()
+        for i, message_text in enumerate(texts):
+            wait = self._last_sent.get(chat_id, 0.0) + PER_CHAT_INTERVAL - time.monotonic()
+            if deadline is not None and (deadline.expired() or wait >= deadline.remaining()):
+                logger.warning("Hết thời gian gửi thông báo, bỏ qua %s tin nhắn còn lại đến %s.", len(texts) - i, chat_id)
+                return
+            if wait > 0:
+                time.sleep(wait)
+            self._rate_limiter.acquire()
+            self.send_message(chat_id, message_text, deadline)
+            self._last_sent[chat_id] = time.monotonic()
 
-        if added:
-            added_str = "\n".join([f"<b>{key}</b>" for key in added])
-            message += f"➕ <b>Nhập thêm ({len(added)}):</b>\n<blockquote>{added_str}</blockquote>\n\n"
-        else:
-            message += "➕ <b>Nhập thêm:</b> Không có\n\n"
+    def queue_message(self, chat_id: str, message_text: str):
+        """
+        Xếp một thông báo vào hàng chờ của chat_id để gửi gộp khi gọi `flush()`.
 
-        if removed:
-            removed_str = "\n".join([f"<b>{key}</b>" for key in removed])
-            message += f"✅ <b>Đã bán ({len(removed)}):</b>\n<blockquote>{removed_str}</blockquote>\n\n"
-        else:
-            message += "✅ <b>Đã bán:</b> Không có\n\n"
+        Các thông báo cùng chat được nối với nhau bằng BATCH_SEPARATOR; khi tin gộp
+        sắp vượt BATCH_LIMIT ký tự thì tin hiện tại được chốt và bắt đầu một tin mới.
 
-        if changed:
-            changed_str = "\n".join([f"<b>{c['key']}</b>: {c['old']} → {c['new']}" for c in changed])
-            message += f"✏️ <b>Thay đổi ({len(changed)}):</b>\n<blockquote>{changed_str}</blockquote>"
+        Args:
+            chat_id: ID của cuộc trò chuyện cần gửi tin nhắn đến.
+            message_text: Nội dung thông báo (HTML).
+        """
+        if not message_text:
+            return
+        pending = self._pending.setdefault(chat_id, [])
+        added_len = len(message_text) + (len(BATCH_SEPARATOR) if pending else 0)
+        if pending and self._pending_len[chat_id] + added_len > BATCH_LIMIT:
+            self._batched.append((chat_id, BATCH_SEPARATOR.join(pending)))
+            pending.clear()
+            added_len = len(message_text)
+            self._pending_len[chat_id] = 0
+        pending.append(message_text)
+        self._pending_len[chat_id] = self._pending_len.get(chat_id, 0) + added_len
+
+    def flush(self, chat_id: Optional[str] = None, wait: bool = False, timeout: Optional[float] = None):
+        """
+        Gửi tất cả các tin đã gộp của một chat_id (hoặc của mọi chat nếu không truyền).
+
+        Mặc định không chờ: tin nhắn được gửi trên các luồng nền, `close()` sẽ chờ gửi hết.
+
+        Args:
+            chat_id: ID của cuộc trò chuyện cần flush; None để flush tất cả.
+            wait: Nếu True, chờ đến khi các tin nhắn được gửi xong.
+            timeout: Tổng thời gian (giây) tối đa cho cả lần flush, tính từ lúc gọi; None nếu không giới hạn.
+        """
+        chat_ids = list(self._pending) if chat_id is None else [chat_id]
+        for pending_chat_id in chat_ids:
+            pending = self._pending.pop(pending_chat_id, None)
+            self._pending_len.pop(pending_chat_id, None)
+            if pending:
+                self._batched.append((pending_chat_id, BATCH_SEPARATOR.join(pending)))
+
+        if chat_id is None:
+            outgoing, self._batched = self._batched, []
         else:
-            message += "✏️ <b>Thay đổi:</b> Không có"
+            outgoing = [item for item in self._batched if item[0] == chat_id]
+            self._batched = [item for item in self._batched if item[0] != chat_id]
+        deadline = _Deadline(timeout) if timeout is not None else None
+        self.send_messages(outgoing, wait=wait, deadline=deadline)
+
+    def format_message(self, result: Dict[str, Any]) -> str:
+        """
+        Định dạng một tin nhắn chuẩn từ kết quả so sánh đã được gom nhóm.
+        """
+        comparison = result.get('comparison') or {}
+        # Chỉ tạo tin nhắn nếu có ít nhất một thay đổi
+        if not (comparison.get('added') or comparison.get('removed') or comparison.get('changed')):
+            return ""
+
+        return _format_cached(
+            result.get('agent_name', 'Không xác định'),
+            result.get('project_name', 'Không xác định'),
+            tuple(comparison.get('added') or ()),
+            tuple(comparison.get('removed') or ()),
+            tuple((c['key'], c['old'], c['new']) for c in comparison.get('changed') or ()),
+        )
 
-        return message.strip()
+    def close(self):
+        """Gửi nốt các tin đang chờ, dừng các luồng gửi nền rồi đóng Session."""
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._session.close()